@@ -12,11 +12,27 @@ from .llm import LLMProvider
 @click.group()
 @click.option('--embedding-model', default=ENV_CONFIG['embedding_model'], help='Embedding model to use')
 @click.option('--db-path', default=ENV_CONFIG['db_path'], help='path for db')
+@click.option('--search-mode', default=ENV_CONFIG['search_mode'], type=click.Choice(['exact', 'two_stage']), help='Search mode for the db')
+@click.option('--projection', default=ENV_CONFIG['projection'], type=click.Choice(['pca', 'truncate']), help='Projection for two_stage search')
+@click.option('--projection-dim', default=ENV_CONFIG['projection_dim'], help='Dimensions kept for the two_stage prefilter')
+@click.option('--candidate-multiplier', default=ENV_CONFIG['candidate_multiplier'], help='Candidates re-scored per result in two_stage search')
+@click.option('--dedup-threshold', default=ENV_CONFIG['dedup_threshold'], help='Similarity at which documents are considered duplicates')
+@click.option('--collapse-duplicates/--no-collapse-duplicates', default=ENV_CONFIG['collapse_duplicates'], help='Collapse near-duplicate search results')
+@click.option('--collapse-multiplier', default=ENV_CONFIG['collapse_multiplier'], help='Results fetched per result when collapsing duplicates')
+@click.option('--shards', default=ENV_CONFIG['shards'], help='Number of shard files to partition the db across')
 @click.pass_context
-def cli(ctx, embedding_model, db_path):
+def cli(ctx, embedding_model, db_path, search_mode, projection, projection_dim, candidate_multiplier, dedup_threshold, collapse_duplicates, collapse_multiplier, shards):
     config = ChatConfig(
         embedding_model=embedding_model,
         db_path=db_path,
+        search_mode=search_mode,
+        projection=projection,
+        projection_dim=projection_dim,
+        candidate_multiplier=candidate_multiplier,
+        dedup_threshold=dedup_threshold,
+        collapse_duplicates=collapse_duplicates,
+        collapse_multiplier=collapse_multiplier,
+        shards=shards,
     )
     ctx.obj = DocumentQueryModel.from_config(config)
 
@@ -30,10 +46,21 @@ def cli(ctx, embedding_model, db_path):
 @click.option('--system-message', default=ENV_CONFIG['system_message'], help='System message for the chat')
 @click.option('--max-tokens', default=ENV_CONFIG['max_tokens'], help='Maximum number of tokens for LLM response')
 @click.option('--temperature', default=ENV_CONFIG['temperature'], help='Temperature for LLM response')
+@click.option('--fallback-provider', multiple=True, help='Fallback LLM provider, hedged against the primary; may be repeated')
+@click.option('--fallback-api-key', multiple=True, help='API key for each fallback provider, in order; one is required per provider')
+@click.option('--hedge-delay', default=ENV_CONFIG['hedge_delay'], help='Seconds to wait for a first token before hedging to a fallback')
 @click.pass_obj
-def chat(dqm: DocumentQueryModel, embedding_model, db_path, llm_provider, model_url, api_key, user_id, system_message, max_tokens, temperature):
+def chat(dqm: DocumentQueryModel, embedding_model, db_path, llm_provider, model_url, api_key, user_id, system_message, max_tokens, temperature, fallback_provider, fallback_api_key, hedge_delay):
     """Start a new chat session"""
 
+    # Each fallback needs its own key, so one vendor's credential is never sent to another
+    if len(fallback_api_key) != len(fallback_provider):
+        raise click.BadParameter("Expected one --fallback-api-key per --fallback-provider")
+    fallbacks = [
+        ChatConfig(llm_provider=provider, api_key=key)
+        for provider, key in zip(fallback_provider, fallback_api_key)
+    ]
+
     config = ChatConfig(
         embedding_model=embedding_model,
         db_path=db_path,
@@ -44,6 +71,8 @@ def chat(dqm: DocumentQueryModel, embedding_model, db_path, llm_provider, model_
         user_id=user_id,
         max_tokens=max_tokens,
         temperature=temperature,
+        fallbacks=fallbacks,
+        hedge_delay=hedge_delay,
     )
 
     llm = LLMProvider.from_config(config)
@@ -55,11 +84,41 @@ def chat(dqm: DocumentQueryModel, embedding_model, db_path, llm_provider, model_
 @click.argument('file_path', type=click.Path(exists=True))
 @click.option('--id-key', default='area_id', help='The key to use for our doc ID')
 @click.option('--content-key', default='summary', help='The key to use for our doc content')
+@click.option('--dedup', is_flag=True, help='Collapse near-duplicate documents in to one, keeping the others as aliases')
+@click.option('--embedding-key', default='embedding', help='The key holding a precomputed embedding, if present')
+@click.option('--embeddings', 'embeddings_path', type=click.Path(exists=True), help='Precomputed embeddings: a .npy with one row per line, or a .npz with ids')
 @click.pass_obj
-def load_area_data(dqm: DocumentQueryModel, file_path, id_key, content_key):
-    dqm.load_jsonl(file_path, id_key=id_key, content_key=content_key)
+def load_area_data(dqm: DocumentQueryModel, file_path, id_key, content_key, dedup, embedding_key, embeddings_path):
+    """Load a JSONL file, or a .npz written by export-embeddings"""
+    if file_path.endswith('.npz'):
+        added = dqm.load_npz(file_path, dedup=dedup)
+    else:
+        added = dqm.load_jsonl(file_path, id_key=id_key, content_key=content_key, dedup=dedup,
+                               embedding_key=embedding_key, embeddings_path=embeddings_path)
     dqm.save()
-    click.echo(f"Data loaded from {file_path}")
+    click.echo(f"Data loaded from {file_path}: {added} documents added, {dqm.document_count} in the index")
+
+@cli.command()
+@click.argument('file_path', type=click.Path())
+@click.option('--id-key', default='area_id', help='The key to write our doc ID under, in a .jsonl file')
+@click.option('--content-key', default='summary', help='The key to write our doc content under, in a .jsonl file')
+@click.pass_obj
+def export_embeddings(dqm: DocumentQueryModel, file_path, id_key, content_key):
+    """Export documents and embeddings to a .npz or .jsonl file"""
+    exported = dqm.export_embeddings(file_path, id_key=id_key, content_key=content_key)
+    click.echo(f"Exported {exported} documents to {file_path}")
+
+@cli.command()
+@click.option('--query', 'queries', multiple=True, help='A query to evaluate; may be repeated. Defaults to a sample of documents')
+@click.option('--sample', default=20, help='Number of documents to sample as queries when none are given')
+@click.option('--top-n', default=5, help='Number of results to compare per query')
+@click.pass_obj
+def search_recall(dqm: DocumentQueryModel, queries, sample, top_n):
+    """Report the recall of two_stage search against exact search"""
+    if not queries:
+        queries = dqm.data['content'].sample(min(sample, dqm.document_count), random_state=0).tolist()
+    recall = dqm.recall(list(queries), top_n=top_n)
+    click.echo(f"Recall@{top_n} over {len(queries)} queries: {recall:.3f}")
 
 if __name__ == '__main__':
     cli()
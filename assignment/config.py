@@ -18,6 +18,15 @@ ENV_CONFIG = {
     'system_message': os.getenv('SYSTEM_MESSAGE', "You are a helpful assistant."),
     'max_tokens': int(os.getenv('MAX_TOKENS', 256)),
     'temperature': float(os.getenv('TEMPERATURE', 0.7)),
+    'hedge_delay': float(os.getenv('HEDGE_DELAY', 0.5)),
+    'search_mode': os.getenv('SEARCH_MODE', "exact"),
+    'projection': os.getenv('PROJECTION', "pca"),
+    'projection_dim': int(os.getenv('PROJECTION_DIM', 128)),
+    'candidate_multiplier': int(os.getenv('CANDIDATE_MULTIPLIER', 10)),
+    'dedup_threshold': float(os.getenv('DEDUP_THRESHOLD', 0.95)),
+    'collapse_duplicates': os.getenv('COLLAPSE_DUPLICATES', 'false').lower() == 'true',
+    'collapse_multiplier': int(os.getenv('COLLAPSE_MULTIPLIER', 4)),
+    'shards': int(os.getenv('SHARDS', 1)),
 }
 
 
@@ -37,6 +46,19 @@ class ChatConfig:
     repetition: Optional[float] = None
     debug: bool = False
     stop_sequences: List[str] = field(default_factory=lambda: ["You:", "<|im_end|>", "</s>"])
+    fallbacks: List['ChatConfig'] = field(default_factory=list)
+    hedge_delay: float = 0.5
+    breaker_failures: int = 3
+    breaker_reset: float = 30.0
+    search_mode: str = "exact"
+    projection: str = "pca"
+    projection_dim: int = 128
+    candidate_multiplier: int = 10
+    dedup_threshold: float = 0.95
+    collapse_duplicates: bool = False
+    collapse_multiplier: int = 4
+    shards: int = 1
+    shard_workers: Optional[int] = None
 
     @classmethod
     def from_env(cls):
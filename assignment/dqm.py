@@ -1,11 +1,15 @@
 # assignment/dqm.py
 
+from concurrent.futures import ThreadPoolExecutor
+import glob
+import heapq
 import json
 import os
+import re
+import zlib
 import numpy as np
 import pandas as pd
-from sklearn.metrics.pairwise import cosine_similarity
-from typing import Callable, Optional
+from typing import Callable, Dict, List, Optional, Tuple, Union
 
 from .config import ChatConfig
 from .embedding import HuggingFaceEmbedding
@@ -19,6 +23,10 @@ class DocumentQueryModel:
     Attributes:
         ef: The embedding function to use for indexing documents.
         preprocess: A callable strategy for preprocessing and indexing documents and queries.
+        search_mode: 'exact' scans every full embedding; 'two_stage' scans a low-dimensional projection for
+            candidates, and re-scores only those with the full embeddings.
+        dedup_threshold: The cosine similarity at or above which two documents are considered duplicates.
+        collapse_duplicates: Whether queries collapse near-duplicate results in to one by default.
 
     Usage:
         embedding_function = lambda x: np.random.rand(1, 100)  # Example embedding function that returns random embeddings
@@ -39,7 +47,10 @@ class DocumentQueryModel:
 
     """
 
-    def __init__(self, data: pd.DataFrame, db_path: str, embedding_function: Callable[[str], np.ndarray]):
+    def __init__(self, data: pd.DataFrame, db_path: str, embedding_function: Callable[[str], np.ndarray],
+                 search_mode: str = "exact", projection: str = "pca", projection_dim: int = 128, candidate_multiplier: int = 10,
+                 dedup_threshold: float = 0.95, collapse_duplicates: bool = False, collapse_multiplier: int = 4,
+                 components: Optional[np.ndarray] = None, refit_growth: float = 1.25):
         """
         Initializes the DocumentQueryModel with a simple pandas DataFrame.
 
@@ -47,7 +58,30 @@ class DocumentQueryModel:
             data: The indexed data to use for the document query model.
             db_path: The path to the data file.
             embedding_function: A callable strategy (function) that calculates the embedding for a document.
+            search_mode: 'exact' or 'two_stage'.
+            projection: How two_stage reduces embeddings: 'pca' (fit at ingest) or 'truncate' (leading dimensions,
+                for Matryoshka-style models).
+            projection_dim: The number of dimensions to keep for the first stage.
+            candidate_multiplier: The first stage keeps top_n * candidate_multiplier candidates for re-scoring.
+            dedup_threshold: The similarity threshold for duplicate detection, at ingest and at query time.
+            collapse_duplicates: The default for query's collapse option.
+            collapse_multiplier: Collapsing queries over-fetch top_n * collapse_multiplier results, so there are still
+                top_n once duplicates are folded in. This is independent of candidate_multiplier, which applies on top
+                of it in two_stage mode.
+            components: A previously fit projection, as returned by read_projection. It is ignored if it doesn't
+                have projection_dim rows.
+            refit_growth: A bulk insert refits the PCA projection once the index is this many times larger than it
+                was when the projection was last fit.
         """
+        if search_mode not in ("exact", "two_stage"):
+            raise ValueError(f"Unknown search mode: {search_mode}")
+        if projection not in ("pca", "truncate"):
+            raise ValueError(f"Unknown projection: {projection}")
+
+        # Older data files predate the aliases column
+        if 'aliases' not in data.columns:
+            data['aliases'] = [() for _ in range(len(data))]
+
         # Our data
         self.data = data
         self.db_path = db_path
@@ -55,16 +89,95 @@ class DocumentQueryModel:
         # Initialize the embedding function
         self.ef = embedding_function
 
+        self.search_mode = search_mode
+        self.projection = projection
+        self.projection_dim = projection_dim
+        self.candidate_multiplier = candidate_multiplier
+        self.dedup_threshold = dedup_threshold
+        self.collapse_duplicates = collapse_duplicates
+        self.collapse_multiplier = collapse_multiplier
+        self.refit_growth = refit_growth
+
+        # Search caches, rebuilt lazily after the data changes
+        self._matrix: Optional[np.ndarray] = None
+        self._norms: Optional[np.ndarray] = None
+        self._components: Optional[np.ndarray] = None
+        self._reduced: Optional[np.ndarray] = None
+        self._alias_map: Optional[Dict[str, str]] = None
+
+        # The number of documents the projection was fit to, so small appends don't refit it
+        self._fit_rows = 0
+        if components is not None and components.shape[0] == min(projection_dim, components.shape[1]):
+            self._components = components
+            self._fit_rows = len(data)
+
     @classmethod
     def from_config(cls, config: ChatConfig) -> 'DocumentQueryModel':
         """
         Initializes the DocumentQueryModel from a file. Since we have embeddings we use a binary format.
+
+        With config.shards above one, this returns a ShardedDocumentQueryModel.
+        """
+        if config.shards > 1 and cls is DocumentQueryModel:
+            return ShardedDocumentQueryModel.from_config(config)
+
+        cls.check_layout(config.db_path, config.shards)
+        embedding_function = HuggingFaceEmbedding(model_name=config.embedding_model)
+
+        return cls(
+            data=cls.read(config.db_path),
+            db_path=config.db_path,
+            embedding_function=embedding_function,
+            components=cls.read_projection(config.db_path, config.projection),
+            **cls.options_for(config),
+        )
+
+    @staticmethod
+    def check_layout(db_path: str, shards: int) -> None:
+        """
+        Raises a ValueError if the data on disk was saved with a different number of shards, which would otherwise
+        load as an empty or partial index, and then be saved alongside the old files.
+        """
+        root, ext = os.path.splitext(db_path)
+        pattern = re.compile(re.escape(root) + r"\.\d+-of-(\d+)" + re.escape(ext) + "$")
+        found = {int(m.group(1)) for m in map(pattern.match, glob.glob(f"{glob.escape(root)}.*-of-*{ext}")) if m}
+        if shards > 1 and os.path.exists(db_path):
+            found.add(1)
+        found.discard(shards)
+        if found:
+            saved = ", ".join(str(n) for n in sorted(found))
+            raise ValueError(f"'{db_path}' was saved with {saved} shard(s), but {shards} were requested.")
+
+    @staticmethod
+    def projection_path(db_path: str) -> str:
+        """
+        Returns the file the two_stage projection is saved to, e.g. data.pkl -> data.projection.npz
+        """
+        return f"{os.path.splitext(db_path)[0]}.projection.npz"
+
+    @classmethod
+    def read_projection(cls, db_path: str, projection: str) -> Optional[np.ndarray]:
+        """
+        Reads the projection saved with a data file, if there is one and it was fit with the same method.
+        """
+        path = cls.projection_path(db_path)
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as saved:
+            if str(saved['projection']) != projection:
+                return None
+            return saved['components']
+
+    @classmethod
+    def read(cls, db_path: str) -> pd.DataFrame:
+        """
+        Reads and validates the indexed data from a file, or returns new data if the file does not exist.
         """
-        if not config.db_path.endswith(".pkl"):
-            raise ValueError(f"Invalid file format in '{config.db_path}'. Expected .pkl file.")
+        if not db_path.endswith(".pkl"):
+            raise ValueError(f"Invalid file format in '{db_path}'. Expected .pkl file.")
         
-        if os.path.exists(config.db_path):
-            data = pd.read_pickle(config.db_path)
+        if os.path.exists(db_path):
+            data = pd.read_pickle(db_path)
         else:
             data = cls.new()
         # Validate headers are "embedding" and "document", and the index is "doc_id"
@@ -72,13 +185,21 @@ class DocumentQueryModel:
             raise ValueError("Invalid data format. Expected columns: 'embedding', 'content'")
         if data.index.name != "doc_id":
             raise ValueError("Invalid data format. Expected index name: 'doc_id'")
+        return data
 
-        embedding_function = HuggingFaceEmbedding(model_name=config.embedding_model)
-
-        return cls(
-            data=data,
-            db_path=config.db_path,
-            embedding_function=embedding_function,
+    @staticmethod
+    def options_for(config: ChatConfig) -> dict:
+        """
+        Returns the search and dedup keyword arguments for the constructor.
+        """
+        return dict(
+            search_mode=config.search_mode,
+            projection=config.projection,
+            projection_dim=config.projection_dim,
+            candidate_multiplier=config.candidate_multiplier,
+            dedup_threshold=config.dedup_threshold,
+            collapse_duplicates=config.collapse_duplicates,
+            collapse_multiplier=config.collapse_multiplier,
         )
 
     @classmethod
@@ -86,28 +207,319 @@ class DocumentQueryModel:
         """
         Initializes a new DocumentQueryModel with an empty data frame.
         """
-        data = pd.DataFrame(columns=["embedding", "content"])
+        data = pd.DataFrame(columns=["embedding", "content", "aliases"])
         data.index.name = "doc_id"
         return data
 
-    def load_jsonl(self, file_path: str, id_key: str, content_key: str) -> None:
+    def load_jsonl(self, file_path: str, id_key: str, content_key: str, dedup: bool = False,
+                   embedding_key: str = 'embedding', embeddings_path: Optional[str] = None) -> int:
         """
         Load data from a JSONL file
+
+        Documents are only embedded if no precomputed embedding is available, either from the embedding_key field of
+        the line, or from embeddings_path.
+
+        Args:
+            file_path: The path to the JSONL file.
+            id_key: The key to use for our doc ID.
+            content_key: The key to use for our doc content.
+            dedup: Collapse near-duplicates of documents in the batch or the existing index in to one document.
+            embedding_key: The key holding a precomputed embedding, if any.
+            embeddings_path: A .npy file with one row per line of the JSONL file, or a .npz file with 'ids' and
+                'embeddings' arrays.
+
+        An 'aliases' field, as written by export_embeddings, restores the IDs collapsed in to each document.
+
+        Returns:
+            The number of documents added to the index.
         """
         with open(file_path, 'r') as file:
-            for line in file:
-                try:
-                    data = json.loads(line)
-                    self.insert(data[id_key], content=data[content_key])
-                except ValueError as ve:
-                    print(f"Insert Error: {ve}")
+            lines = [line for line in file if line.strip()]
+
+        precomputed: Dict[str, np.ndarray] = {}
+        by_line: Optional[np.ndarray] = None
+        if embeddings_path is not None:
+            ids, matrix, _ = self.read_embeddings(embeddings_path)
+            if ids is None:
+                if matrix.shape[0] != len(lines):
+                    raise ValueError(f"Expected {len(lines)} embeddings in '{embeddings_path}', found {matrix.shape[0]}")
+                by_line = matrix
+            else:
+                precomputed = dict(zip(ids, matrix))
+
+        doc_ids, contents, embeddings, aliases = [], [], [], []
+        for i, line in enumerate(lines):
+            try:
+                data = json.loads(line)
+                if by_line is not None:
+                    embedding = by_line[i]
+                elif data[id_key] in precomputed:
+                    embedding = precomputed[data[id_key]]
+                elif data.get(embedding_key) is not None:
+                    embedding = self._check_dimension(np.asarray(data[embedding_key], dtype=np.float32))
+                else:
+                    embedding = self.ef(data[content_key])
+                embeddings.append(embedding)
+                doc_ids.append(data[id_key])
+                contents.append(data[content_key])
+                aliases.append(tuple(data.get('aliases') or ()))
+            except (ValueError, KeyError) as ve:
+                print(f"Insert Error: {ve}")
+
+        if by_line is not None and len(embeddings) == by_line.shape[0]:
+            # Every line loaded, so the rows line up with the matrix, which can back the index as it is
+            embeddings = by_line
+        return self.insert_many(doc_ids, contents, embeddings, dedup=dedup, aliases=aliases)
+
+    def load_npz(self, file_path: str, dedup: bool = False) -> int:
+        """
+        Load documents and their embeddings from a .npz file written by export_embeddings, without embedding anything.
+
+        Returns:
+            The number of documents added to the index.
+        """
+        ids, matrix, contents = self.read_embeddings(file_path)
+        if ids is None or contents is None:
+            raise ValueError(f"Expected 'ids' and 'contents' arrays in '{file_path}'")
+        with np.load(file_path) as bundle:
+            # Each document's aliases are stored as a JSON list, since they are ragged
+            aliases = [tuple(json.loads(a)) for a in bundle['aliases'].tolist()] if 'aliases' in bundle else None
+        return self.insert_many(ids, contents, matrix, dedup=dedup, aliases=aliases)
+
+    def read_embeddings(self, file_path: str) -> Tuple[Optional[List[str]], np.ndarray, Optional[List[str]]]:
+        """
+        Reads and validates precomputed embeddings.
+
+        Args:
+            file_path: A .npy file holding just the embedding matrix, which is memory-mapped, or a .npz file holding
+                an 'embeddings' matrix, and optionally 'ids', 'contents', 'aliases' and 'model' arrays.
+
+        Returns:
+            The document IDs, the embedding matrix, and the document contents, where present.
+        """
+        if file_path.endswith(".npy"):
+            ids, matrix, contents = None, np.load(file_path, mmap_mode='r'), None
+        elif file_path.endswith(".npz"):
+            with np.load(file_path) as bundle:
+                if 'embeddings' not in bundle:
+                    raise ValueError(f"Expected an 'embeddings' array in '{file_path}'")
+                model_name = getattr(self.ef, 'model_name', None)
+                if 'model' in bundle and model_name is not None and str(bundle['model']) != model_name:
+                    raise ValueError(f"Embeddings in '{file_path}' are from {bundle['model']}, expected {model_name}")
+                matrix = bundle['embeddings']
+                ids = bundle['ids'].tolist() if 'ids' in bundle else None
+                contents = bundle['contents'].tolist() if 'contents' in bundle else None
+        else:
+            raise ValueError(f"Invalid file format in '{file_path}'. Expected .npy or .npz file.")
+
+        if matrix.ndim != 2:
+            raise ValueError(f"Expected a 2D embedding matrix in '{file_path}', found shape {matrix.shape}")
+        if ids is not None and len(ids) != matrix.shape[0]:
+            raise ValueError(f"Expected {matrix.shape[0]} ids in '{file_path}', found {len(ids)}")
+        # A .npy is memory-mapped; it is only copied if it isn't float32 already
+        matrix = self._check_dimension(np.asarray(matrix, dtype=np.float32))
+        return ids, matrix, contents
+
+    def export_embeddings(self, file_path: str, id_key: str = 'doc_id', content_key: str = 'content') -> int:
+        """
+        Exports every document, its embedding and its aliases, so an index can be built once and loaded elsewhere
+        without embedding anything.
+
+        Args:
+            file_path: A .npz file (for load_npz), or a .jsonl file (for load_jsonl) with id_key, content_key,
+                'embedding' and 'aliases' fields.
+            id_key: The key to write our doc ID under, in a .jsonl file.
+            content_key: The key to write our doc content under, in a .jsonl file.
+
+        Returns:
+            The number of documents exported.
+        """
+        data = self.data
+        if file_path.endswith(".npz"):
+            matrix = np.stack(data['embedding'].values) if not data.empty else np.empty((0, self.dimension or 0))
+            np.savez(
+                file_path,
+                ids=self._id_array(data.index),
+                contents=np.array(data['content'], dtype=str),
+                embeddings=matrix.astype(np.float32),
+                aliases=np.array([json.dumps(list(a)) for a in data['aliases']], dtype=str),
+                model=np.array(getattr(self.ef, 'model_name', '')),
+            )
+        elif file_path.endswith(".jsonl"):
+            with open(file_path, 'w') as file:
+                for doc_id, row in data.iterrows():
+                    record = {
+                        id_key: doc_id,
+                        content_key: row['content'],
+                        'embedding': np.asarray(row['embedding']).tolist(),
+                        'aliases': list(row['aliases']),
+                    }
+                    file.write(json.dumps(record) + "\n")
+        else:
+            raise ValueError(f"Invalid file format in '{file_path}'. Expected .npz or .jsonl file.")
+        return data.shape[0]
+
+    @staticmethod
+    def _id_array(ids) -> np.ndarray:
+        """
+        Returns document IDs as an array that loads back as the same IDs. Only all-string or all-integer IDs can be
+        stored without pickling.
+        """
+        ids = list(ids)
+        if all(isinstance(i, str) for i in ids):
+            return np.array(ids, dtype=str)
+        if all(isinstance(i, (int, np.integer)) and not isinstance(i, bool) for i in ids):
+            return np.array(ids, dtype=np.int64)
+        raise ValueError("Only indexes whose IDs are all strings or all integers can be exported to .npz")
+
+    @property
+    def dimension(self) -> Optional[int]:
+        """
+        The embedding dimension, from the embedding function if it knows it, otherwise from the indexed data.
+        """
+        dimension = getattr(self.ef, 'dimension', None)
+        if dimension is None and self.document_count > 0:
+            dimension = len(self.data['embedding'].iloc[0])
+        return dimension
+
+    def _check_dimension(self, embeddings: np.ndarray) -> np.ndarray:
+        """
+        Raises a ValueError if precomputed embeddings don't match the embedding model's dimension.
+        """
+        dimension = self.dimension
+        if dimension is not None and embeddings.shape[-1] != dimension:
+            raise ValueError(f"Expected embeddings of dimension {dimension}, found {embeddings.shape[-1]}")
+        return embeddings
+
+    def insert_many(self, doc_ids: List[str], contents: List[str], embeddings: Union[List[np.ndarray], np.ndarray], dedup: bool = False,
+                    aliases: Optional[List[Tuple[str, ...]]] = None) -> int:
+        """
+        Inserts a batch of already embedded documents, replacing any with the same IDs.
+
+        Args:
+            doc_ids: The unique identifiers for the documents.
+            contents: The documents to insert.
+            embeddings: The embedding for each document, or a (documents, dim) matrix. Inserting a float32 matrix in
+                to an empty index doesn't copy it; it backs the documents' embeddings and the search.
+            dedup: Collapse near-duplicates of documents in the batch or the existing index in to one document.
+            aliases: The IDs already collapsed in to each document, e.g. from an exported index.
+
+        Returns:
+            The number of documents added to the index.
+        """
+        if not doc_ids:
+            return 0
+
+        matrix = np.asarray(embeddings, dtype=np.float32) if isinstance(embeddings, np.ndarray) else None
+        batch = self._batch(doc_ids, contents, embeddings if matrix is None else matrix, aliases)
+        if dedup:
+            batch, self.data = self._dedup(batch, self.data.drop(index=batch.index, errors='ignore'))
+            self._alias_map = None
+
+        # The matrix only lines up with the batch if no documents were dropped
+        return self._append(batch, matrix if matrix is not None and batch.shape[0] == matrix.shape[0] else None)
+
+    @staticmethod
+    def _batch(doc_ids: List[str], contents: List[str], embeddings: List[np.ndarray],
+               aliases: Optional[List[Tuple[str, ...]]] = None) -> pd.DataFrame:
+        """
+        Builds a frame of new documents, keeping the last of any repeated IDs.
+        """
+        aliases = [() for _ in doc_ids] if aliases is None else [tuple(a) for a in aliases]
+        # Rows of a matrix are views, not copies
+        batch = pd.DataFrame(
+            {'embedding': list(embeddings), 'content': list(contents), 'aliases': aliases},
+            index=pd.Index(doc_ids, name='doc_id'),
+        )
+        return batch[~batch.index.duplicated(keep='last')]
+
+    def _append(self, batch: pd.DataFrame, matrix: Optional[np.ndarray] = None) -> int:
+        """
+        Appends a frame of documents, replacing any with the same IDs.
+
+        Args:
+            batch: The documents to append.
+            matrix: The batch's embeddings as one float32 matrix, row for row. If the index was empty, it is used as
+                the search matrix as is.
+        """
+        self._drop_aliases(batch.index)
+        existing = self.data.drop(index=batch.index, errors='ignore')
+        self.data = batch if existing.empty else pd.concat([existing, batch])
+
+        self._invalidate()
+        if existing.empty and matrix is not None:
+            self._matrix = matrix
+        if self.document_count == 0:
+            self._components = None
+        elif self.search_mode == "two_stage" and self.projection == "pca" and (
+                self._components is None or self.document_count > self._fit_rows * self.refit_growth):
+            # Refit the projection once the index has grown enough, so queries never have to
+            self._components = self._fit_projection(self._embedding_matrix())
+
+        return batch.shape[0]
+
+    def _dedup(self, batch: pd.DataFrame, existing: pd.DataFrame, block_size: int = 1024) -> Tuple[pd.DataFrame, pd.DataFrame]:
+        """
+        Drops batch documents that are near-duplicates of an existing document or an earlier batch document, and
+        records their IDs as aliases of the representative that was kept.
+
+        The batch is compared in blocks, against the existing documents and every representative kept so far.
+
+        Returns:
+            The batch and existing documents, updated.
+        """
+        batch_matrix = self._normalize(np.stack(batch['embedding'].values).astype(np.float32))
+        if existing.empty:
+            reps = np.empty((0, batch_matrix.shape[1]), dtype=np.float32)
+        else:
+            reps = self._normalize(np.stack(existing['embedding'].values).astype(np.float32))
+        rep_ids = list(existing.index)
+
+        aliases: Dict[str, List[str]] = {}
+        keep = np.ones(batch.shape[0], dtype=bool)
+        for start in range(0, batch.shape[0], block_size):
+            block = batch_matrix[start:start + block_size]
+            # Similarity to the representatives from before this block, and within the block
+            against_reps = block @ reps.T
+            within = block @ block.T
+            for k in range(block.shape[0]):
+                best_sim, best_id = -1.0, None
+                if against_reps.shape[1]:
+                    j = int(np.argmax(against_reps[k]))
+                    best_sim, best_id = against_reps[k, j], rep_ids[j]
+                earlier = np.flatnonzero(keep[start:start + k])
+                if earlier.size:
+                    j = earlier[np.argmax(within[k, earlier])]
+                    if within[k, j] > best_sim:
+                        best_sim, best_id = within[k, j], batch.index[start + j]
+                if best_sim >= self.dedup_threshold:
+                    keep[start + k] = False
+                    # The dropped document's own aliases now resolve to the representative too
+                    dropped = batch.index[start + k]
+                    aliases.setdefault(best_id, []).extend((dropped, *batch.at[dropped, 'aliases']))
+            kept = keep[start:start + block_size]
+            reps = np.concatenate([reps, block[kept]])
+            rep_ids.extend(batch.index[start:start + block_size][kept])
+
+        batch = batch[keep].copy()
+        existing = existing.copy()
+        for rep_id, alias_ids in aliases.items():
+            frame = batch if rep_id in batch.index else existing
+            frame.at[rep_id, 'aliases'] = tuple(frame.at[rep_id, 'aliases']) + tuple(alias_ids)
+        return batch, existing
 
     def save(self):
         """
-        Saves the indexed data to a file.
+        Saves the indexed data to a file, and the two_stage projection alongside it.
         """
         self.data.to_pickle(self.db_path)
 
+        path = self.projection_path(self.db_path)
+        if self._components is not None:
+            np.savez(path, components=self._components, projection=np.array(self.projection))
+        elif os.path.exists(path):
+            os.remove(path)
+
     @property
     def document_count(self) -> int:
         """
@@ -135,32 +547,193 @@ class DocumentQueryModel:
         embedding = self.ef(content)
 
         # Add the document and its embedding to the collection
-        self.data.loc[doc_id] = [embedding, content]
+        self._drop_aliases([doc_id])
+        self.data.loc[doc_id] = [embedding, content, ()]
+        self._invalidate()
 
         return embedding
 
-    def query(self, query_text: str, top_n: int = 5) -> pd.DataFrame:
+    def _invalidate(self) -> None:
+        """
+        Drops the cached search matrices. The projection itself is kept, and only refit by a large bulk insert.
+        """
+        self._matrix = None
+        self._norms = None
+        self._reduced = None
+        self._alias_map = None
+
+    def _embedding_matrix(self) -> np.ndarray:
+        """
+        Returns the embedding matrix, in the same row order as self.data. It is not normalized, so it never has to be
+        copied; see _row_norms.
+        """
+        if self._matrix is None or self._matrix.shape[0] != self.data.shape[0]:
+            self._matrix = np.stack(self.data['embedding'].values).astype(np.float32, copy=False)
+            self._norms = None
+        return self._matrix
+
+    def _row_norms(self) -> np.ndarray:
+        """
+        Returns the norm of each row of the embedding matrix, with zeros replaced by one.
+        """
+        matrix = self._embedding_matrix()
+        if self._norms is None or self._norms.shape[0] != matrix.shape[0]:
+            # einsum avoids the (documents, dim) temporary that np.linalg.norm would allocate
+            norms = np.sqrt(np.einsum('ij,ij->i', matrix, matrix))
+            self._norms = np.where(norms == 0, 1, norms).astype(np.float32)
+        return self._norms
+
+    def _normalized_rows(self, rows: np.ndarray) -> np.ndarray:
+        """
+        Returns the given rows of the embedding matrix, normalized.
+        """
+        return self._embedding_matrix()[rows] / self._row_norms()[rows, None]
+
+    @staticmethod
+    def _normalize(matrix: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+        return matrix / np.where(norms == 0, 1, norms)
+
+    def _fit_projection(self, matrix: np.ndarray, max_rows: int = 10000) -> np.ndarray:
+        """
+        Fits the projection used by the first stage of two_stage search. PCA is fit on a sample of at most max_rows
+        rows, which is plenty to find the leading components.
+
+        Returns:
+            A (projection_dim, dim) matrix whose rows span the reduced space.
+        """
+        dim = min(self.projection_dim, matrix.shape[1])
+        if self.projection == "truncate":
+            return np.eye(matrix.shape[1], dtype=matrix.dtype)[:dim]
+        self._fit_rows = matrix.shape[0]
+        if matrix.shape[0] > max_rows:
+            matrix = matrix[np.random.default_rng(0).choice(matrix.shape[0], max_rows, replace=False)]
+        matrix = self._normalize(matrix)
+        # PCA: the leading eigenvectors of the (dim, dim) covariance, which is much cheaper than an SVD of the rows
+        mean = matrix.mean(axis=0, dtype=np.float64)
+        covariance = (matrix.T @ matrix).astype(np.float64) / matrix.shape[0] - np.outer(mean, mean)
+        _, vectors = np.linalg.eigh(covariance)
+        return vectors[:, ::-1][:, :dim].T.astype(matrix.dtype)
+
+    def _reduced_matrix(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the projection components, and the row-normalized projection of every embedding. The projection
+        is normally fit at ingest or loaded with the data; it is only fit here for data saved without one.
+        """
+        matrix = self._embedding_matrix()
+        if self._components is None:
+            self._components = self._fit_projection(matrix)
+        if self._reduced is None or self._reduced.shape[0] != matrix.shape[0]:
+            # Normalizing the projection makes the row norms irrelevant
+            self._reduced = self._normalize(matrix @ self._components.T)
+        return self._components, self._reduced
+
+    def _search(self, query: np.ndarray, top_n: int, search_mode: str) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Finds the top_n rows by cosine similarity to the query embedding.
+
+        Returns:
+            The row positions of the results in self.data, and their similarities, best first.
+        """
+        query = self._normalize(query.astype(np.float32))
+        matrix = self._embedding_matrix()
+        norms = self._row_norms()
+        top_n = min(top_n, matrix.shape[0])
+        if top_n <= 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        if search_mode == "two_stage":
+            components, reduced = self._reduced_matrix()
+            n_candidates = min(top_n * self.candidate_multiplier, matrix.shape[0])
+            coarse = reduced @ self._normalize(components @ query)
+            rows = np.argpartition(-coarse, n_candidates - 1)[:n_candidates]
+            # Exact re-scoring of the candidates with the full vectors
+            scores = (matrix[rows] @ query) / norms[rows]
+        else:
+            rows = None
+            scores = (matrix @ query) / norms
+
+        # Only the top_n scores are sorted
+        best = np.argpartition(-scores, top_n - 1)[:top_n]
+        best = best[np.argsort(-scores[best], kind='stable')]
+        return (best if rows is None else rows[best]), scores[best]
+
+    def query(self, query_text: str, top_n: int = 5, search_mode: Optional[str] = None, collapse: Optional[bool] = None) -> pd.DataFrame:
         """
         Queries the indexed documents using the DQM preprocessing/embedding strategy.
 
         Args:
             query_text: The query as a string.
             top_n: Number of top results to return (default: 5).
+            search_mode: Overrides the model's search mode for this query.
+            collapse: Collapse near-duplicate results in to the best ranked one, adding their IDs to its aliases.
+                Defaults to the model's collapse_duplicates.
 
         Returns:
             A list of document IDs of the top-k results based on similarity, and their distances.
         """
 
-        # Calculate the embedding for the query, reshaped to a 2D array
-        query = self.ef(query_text).reshape(1, -1)
+        # Calculate the embedding for the query
+        query = self.ef(query_text).reshape(-1)
 
-        if self.data.empty:
+        if self.document_count == 0:
             return pd.DataFrame()
-        embeddings = np.stack(self.data['embedding'].values)
 
-        search = self.data.copy()
-        search['distance'] = cosine_similarity(query, embeddings)[0]
-        return search.sort_values(by='distance', ascending=False).head(top_n)
+        collapse = self.collapse_duplicates if collapse is None else collapse
+        # Over-fetch, so there are still top_n results once duplicates are collapsed
+        fetch = top_n * self.collapse_multiplier if collapse else top_n
+        rows, scores = self._search(query, fetch, search_mode or self.search_mode)
+        search, matrix = self._take(rows)
+        search['distance'] = scores
+        if collapse:
+            search = self._collapse(search, matrix, top_n)
+        return search
+
+    def _take(self, rows: np.ndarray) -> Tuple[pd.DataFrame, np.ndarray]:
+        """
+        Returns the documents at the given search result positions, and their normalized embeddings.
+        """
+        return self.data.iloc[rows].copy(), self._normalized_rows(rows)
+
+    def _collapse(self, search: pd.DataFrame, matrix: np.ndarray, top_n: int) -> pd.DataFrame:
+        """
+        Greedily keeps each result unless it is a near-duplicate of a better ranked result that was kept.
+        """
+        similar = matrix @ matrix.T >= self.dedup_threshold
+        kept: List[int] = []
+        for i in range(search.shape[0]):
+            dup_of = next((k for k in kept if similar[i, k]), None)
+            if dup_of is None:
+                if len(kept) == top_n:
+                    break
+                kept.append(i)
+            else:
+                col = search.columns.get_loc('aliases')
+                search.iat[dup_of, col] = tuple(search.iat[dup_of, col]) + (search.index[i],) + tuple(search.iat[i, col])
+        return search.iloc[kept]
+
+    def recall(self, queries: List[str], top_n: int = 5) -> float:
+        """
+        Measures the recall of two_stage search against exact search.
+
+        Args:
+            queries: The query texts to evaluate.
+            top_n: Number of top results to compare per query.
+
+        Returns:
+            The fraction of exact top_n results that two_stage search also returns.
+        """
+        if self.document_count == 0 or not queries:
+            return 1.0
+
+        found = expected = 0
+        for query_text in queries:
+            query = self.ef(query_text).reshape(-1)
+            exact, _ = self._search(query, top_n, "exact")
+            approx, _ = self._search(query, top_n, "two_stage")
+            found += len(np.intersect1d(exact, approx))
+            expected += len(exact)
+        return found / expected
 
     def get_document(self, doc_id: str) -> Optional[str]:
         """
@@ -170,16 +743,230 @@ class DocumentQueryModel:
             doc_id: The ID of the document to retrieve.
 
         Returns:
-            The document content as a string, or None if the document is not found.
+            The document content as a string, or None if the document is not found. Aliases of a collapsed
+            duplicate return the content of the document that was kept.
         """
         try:
             result = self.data.loc[doc_id]
             return result['content']
-        except IndexError:
-            return None
+        except (IndexError, KeyError):
+            pass
+
+        # Resolve documents that were collapsed in to another at ingest
+        rep_id = self._aliases().get(doc_id)
+        return None if rep_id is None else self.data.loc[rep_id]['content']
+
+    def _aliases(self) -> Dict[str, str]:
+        """
+        Returns a map from each alias to the ID of the document it was collapsed in to.
+        """
+        if self._alias_map is None:
+            self._alias_map = {alias: rep_id for rep_id, aliases in self.data['aliases'].items() for alias in aliases}
+        return self._alias_map
+
+    def _drop_aliases(self, doc_ids) -> None:
+        """
+        Removes IDs from the aliases of any document, because they are being inserted as documents of their own.
+        """
+        alias_map = self._aliases()
+        for doc_id in doc_ids:
+            rep_id = alias_map.pop(doc_id, None)
+            if rep_id is not None and rep_id in self.data.index:
+                self.data.at[rep_id, 'aliases'] = tuple(a for a in self.data.at[rep_id, 'aliases'] if a != doc_id)
     
     def clear(self):
         """
         Clears the collection.
         """
-        self.data = self.new()
\ No newline at end of file
+        self.data = self.new()
+        self._components = None
+        self._invalidate()
+
+
+class ShardedDocumentQueryModel(DocumentQueryModel):
+    """
+    A Document Query Model that partitions documents by a hash of their ID across several shards, each a
+    DocumentQueryModel with its own data file.
+
+    Queries embed once, search every shard in parallel on a thread pool (numpy releases the GIL during the matrix
+    products), and merge the per-shard top results. Inserts, lookups, counts and saves route to the shards, so it
+    can be used anywhere a DocumentQueryModel is.
+
+    Usage:
+        dqm = ShardedDocumentQueryModel.from_config(ChatConfig(db_path="data.pkl", shards=4))
+        # Reads and writes data.0-of-4.pkl through data.3-of-4.pkl
+        query_result = dqm.query("This is a sample query.")
+    """
+
+    def __init__(self, shards: List[DocumentQueryModel], db_path: str, embedding_function: Callable[[str], np.ndarray],
+                 max_workers: Optional[int] = None, dedup_threshold: float = 0.95, collapse_duplicates: bool = False,
+                 collapse_multiplier: int = 4):
+        """
+        Initializes the ShardedDocumentQueryModel.
+
+        Args:
+            shards: The shards, in shard order. A document always routes to the same shard for a given shard count.
+            db_path: The base path of the shard files.
+            embedding_function: A callable strategy (function) that calculates the embedding for a document.
+            max_workers: The number of search threads (default: one per shard).
+            dedup_threshold: The similarity threshold for duplicate detection, at ingest and at query time.
+            collapse_duplicates: The default for query's collapse option.
+            collapse_multiplier: Over-fetch factor when collapsing duplicates.
+        """
+        if not shards:
+            raise ValueError("At least one shard is required.")
+        self.shards = shards
+        self.db_path = db_path
+        self.ef = embedding_function
+        self.search_mode = shards[0].search_mode
+        self.dedup_threshold = dedup_threshold
+        self.collapse_duplicates = collapse_duplicates
+        self.collapse_multiplier = collapse_multiplier
+        self.pool = ThreadPoolExecutor(max_workers=max_workers or len(shards))
+
+    @classmethod
+    def from_config(cls, config: ChatConfig) -> 'ShardedDocumentQueryModel':
+        """
+        Initializes the ShardedDocumentQueryModel from its shard files.
+        """
+        cls.check_layout(config.db_path, config.shards)
+        embedding_function = HuggingFaceEmbedding(model_name=config.embedding_model)
+        options = cls.options_for(config)
+
+        shards = []
+        for i in range(config.shards):
+            path = cls.shard_path(config.db_path, i, config.shards)
+            components = cls.read_projection(path, config.projection)
+            shards.append(DocumentQueryModel(cls.read(path), path, embedding_function, components=components, **options))
+
+        return cls(
+            shards=shards,
+            db_path=config.db_path,
+            embedding_function=embedding_function,
+            max_workers=config.shard_workers,
+            dedup_threshold=config.dedup_threshold,
+            collapse_duplicates=config.collapse_duplicates,
+            collapse_multiplier=config.collapse_multiplier,
+        )
+
+    @staticmethod
+    def shard_path(db_path: str, shard: int, shards: int) -> str:
+        """
+        Returns the data file for a shard, e.g. data.pkl -> data.0-of-4.pkl
+        """
+        root, ext = os.path.splitext(db_path)
+        return f"{root}.{shard}-of-{shards}{ext}"
+
+    def _shard_index(self, doc_id: str) -> int:
+        # crc32 is stable across processes, unlike hash()
+        return zlib.crc32(str(doc_id).encode('utf-8')) % len(self.shards)
+
+    def _shard_for(self, doc_id: str) -> DocumentQueryModel:
+        return self.shards[self._shard_index(doc_id)]
+
+    @property
+    def data(self) -> pd.DataFrame:
+        """
+        All documents, gathered from the shards. This copies every shard, so it is for inspection, not for search.
+        """
+        frames = [shard.data for shard in self.shards if not shard.data.empty]
+        return pd.concat(frames) if frames else self.new()
+
+    @property
+    def document_count(self) -> int:
+        return sum(shard.document_count for shard in self.shards)
+
+    def save(self):
+        """
+        Saves every shard to its data file.
+        """
+        for shard in self.shards:
+            shard.save()
+
+    def insert(self, doc_id: str, content: str) -> np.ndarray:
+        # An alias can live on any shard
+        for shard in self.shards:
+            shard._drop_aliases([doc_id])
+        return self._shard_for(doc_id).insert(doc_id, content)
+
+    def insert_many(self, doc_ids: List[str], contents: List[str], embeddings: Union[List[np.ndarray], np.ndarray], dedup: bool = False,
+                    aliases: Optional[List[Tuple[str, ...]]] = None) -> int:
+        """
+        Inserts a batch of already embedded documents, routing each to its shard. Each shard stacks its own part of
+        the embeddings in to its search matrix, so a matrix is copied once, rather than used as is.
+
+        Deduplication runs over the whole batch and every shard, so near-duplicates are found across shards.
+        """
+        if not doc_ids:
+            return 0
+
+        batch = self._batch(doc_ids, contents, embeddings, aliases)
+        if dedup:
+            batch, existing = self._dedup(batch, self.data.drop(index=batch.index, errors='ignore'))
+            # Write back the aliases gained by documents that were already in a shard
+            aliases = existing['aliases']
+            for shard in self.shards:
+                if not shard.data.empty:
+                    shard.data['aliases'] = [aliases.get(i, a) for i, a in shard.data['aliases'].items()]
+                    shard._alias_map = None
+
+        for shard in self.shards:
+            shard._drop_aliases(batch.index)
+
+        owners = np.array([self._shard_index(doc_id) for doc_id in batch.index])
+        for i, shard in enumerate(self.shards):
+            part = batch[owners == i]
+            if not part.empty:
+                shard._append(part)
+
+        return batch.shape[0]
+
+    def _search(self, query: np.ndarray, top_n: int, search_mode: str) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Searches every shard in parallel, and merges their results.
+
+        Returns:
+            Result keys, encoded as row * len(shards) + shard, and their similarities, best first.
+        """
+        n = len(self.shards)
+        searched = [i for i, shard in enumerate(self.shards) if shard.document_count > 0]
+        results = self.pool.map(lambda i: self.shards[i]._search(query, top_n, search_mode), searched)
+
+        best = heapq.nlargest(top_n, (
+            (score, row * n + i)
+            for i, (rows, scores) in zip(searched, results)
+            for row, score in zip(rows, scores)
+        ))
+        keys = np.array([key for _, key in best], dtype=np.int64)
+        scores = np.array([score for score, _ in best], dtype=np.float32)
+        return keys, scores
+
+    def _take(self, rows: np.ndarray) -> Tuple[pd.DataFrame, np.ndarray]:
+        if len(rows) == 0:
+            return self.new(), np.empty((0, self.dimension or 0), dtype=np.float32)
+        n = len(self.shards)
+        frames, vectors = [], []
+        for key in rows:
+            shard = self.shards[key % n]
+            frames.append(shard.data.iloc[[key // n]])
+            vectors.append(shard._normalized_rows(key // n))
+        return pd.concat(frames), np.stack(vectors)
+
+    def get_document(self, doc_id: str) -> Optional[str]:
+        """
+        Retrieves a document from its shard. An alias may live on a different shard to its representative, so on a
+        miss the other shards are checked too.
+        """
+        owner = self._shard_for(doc_id)
+        for shard in [owner, *[shard for shard in self.shards if shard is not owner]]:
+            content = shard.get_document(doc_id)
+            if content is not None:
+                return content
+        return None
+
+    def clear(self):
+        """
+        Clears every shard.
+        """
+        for shard in self.shards:
+            shard.clear()
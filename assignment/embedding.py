@@ -2,7 +2,7 @@
 
 import numpy as np
 import torch
-from transformers import AutoTokenizer, AutoModel
+from transformers import AutoConfig, AutoTokenizer, AutoModel
 
 
 class HuggingFaceEmbedding:
@@ -16,12 +16,36 @@ class HuggingFaceEmbedding:
         Usage:
             embedding = HuggingFaceEmbedding()
             text_embedding_vector = embedding("This is a sample text.")
+
+        The tokenizer and model are loaded on first use, so loading precomputed embeddings never loads the weights.
         """
         self.model_name = model_name
-        # Initialize the tokenizer and model
-        # the clean_up_tokenization_spaces is explicitly set to the default to suppress a warning
-        self.tokenizer = AutoTokenizer.from_pretrained(model_name, clean_up_tokenization_spaces=False)
-        self.model = AutoModel.from_pretrained(model_name)
+        self._tokenizer = None
+        self._model = None
+        self._dimension = None
+
+    @property
+    def tokenizer(self):
+        if self._tokenizer is None:
+            # the clean_up_tokenization_spaces is explicitly set to the default to suppress a warning
+            self._tokenizer = AutoTokenizer.from_pretrained(self.model_name, clean_up_tokenization_spaces=False)
+        return self._tokenizer
+
+    @property
+    def model(self):
+        if self._model is None:
+            self._model = AutoModel.from_pretrained(self.model_name)
+        return self._model
+
+    @property
+    def dimension(self) -> int:
+        """
+        The size of the embedding vectors, read from the model config without loading the weights.
+        """
+        if self._dimension is None:
+            config = self._model.config if self._model is not None else AutoConfig.from_pretrained(self.model_name)
+            self._dimension = config.hidden_size
+        return self._dimension
 
     def __call__(self, text: str) -> np.ndarray:
         """
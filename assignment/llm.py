@@ -1,7 +1,11 @@
 # assignment/llm.py
 
 from abc import ABC, abstractmethod
+from dataclasses import dataclass
 import logging
+import queue
+import threading
+import time
 from typing import Dict, List, Optional, Generator
 
 from .config import ChatConfig
@@ -21,6 +25,21 @@ class LLMProvider(ABC):
 
     @classmethod
     def from_config(cls, config: ChatConfig) -> 'LLMProvider':
+        provider = cls._provider_for(config)
+        if not config.fallbacks:
+            return provider
+
+        # With fallbacks configured, we wrap every backend in a hedged composite
+        backends = [provider, *[cls._provider_for(f) for f in config.fallbacks]]
+        return HedgedProvider(
+            backends,
+            hedge_delay=config.hedge_delay,
+            breaker_failures=config.breaker_failures,
+            breaker_reset=config.breaker_reset,
+        )
+
+    @classmethod
+    def _provider_for(cls, config: ChatConfig) -> 'LLMProvider':
         if config.llm_provider == "openai":
             if config.model_url:
                 return OpenAIProvider.from_url(config.model_url, config.api_key)
@@ -134,4 +153,210 @@ class AIStudioProvider(LLMProvider):
             logger.error(f"Error generating content: {e}")
             yield ""
             
-        return 
+        return
+
+
+@dataclass
+class BackendHealth:
+    """
+    Health and circuit breaker state for a single backend of a HedgedProvider.
+
+    Attributes:
+        name: A display name for the backend.
+        successes: The number of completed streams.
+        failures: The number of consecutive failures; reset on success.
+        total_failures: The number of failures over the lifetime of the provider.
+        ttft: An exponentially weighted moving average of time to first token, in seconds. Backends that lose a
+            race after waiting at least hedge_delay contribute how long they had waited, which is a lower bound on
+            their time to first token.
+        sampled_at: When ttft was last updated.
+        opened_at: When the circuit breaker last tripped.
+    """
+    name: str
+    successes: int = 0
+    failures: int = 0
+    total_failures: int = 0
+    ttft: Optional[float] = None
+    sampled_at: Optional[float] = None
+    opened_at: Optional[float] = None
+
+    def state(self, breaker_failures: int, breaker_reset: float) -> str:
+        """
+        Returns 'closed', 'open' or 'half_open'. An open breaker becomes half open after breaker_reset seconds,
+        which lets a single request through to probe the backend.
+        """
+        if self.failures < breaker_failures:
+            return 'closed'
+        if self.opened_at is not None and time.monotonic() - self.opened_at < breaker_reset:
+            return 'open'
+        return 'half_open'
+
+    def is_slow(self, hedge_delay: float, max_age: float) -> bool:
+        """
+        Whether the backend has recently been taking at least hedge_delay to produce a first token. Samples older
+        than max_age are forgotten, so a demoted backend is tried first again once that long has passed.
+        """
+        if self.ttft is None or self.sampled_at is None or time.monotonic() - self.sampled_at >= max_age:
+            return False
+        return self.ttft >= hedge_delay
+
+    def record_ttft(self, ttft: float, alpha: float = 0.3) -> None:
+        self.ttft = ttft if self.ttft is None else alpha * ttft + (1 - alpha) * self.ttft
+        self.sampled_at = time.monotonic()
+
+    def record_success(self, ttft: float) -> None:
+        self.successes += 1
+        self.failures = 0
+        self.opened_at = None
+        self.record_ttft(ttft)
+
+    def record_failure(self, breaker_failures: int) -> None:
+        self.failures += 1
+        self.total_failures += 1
+        if self.failures >= breaker_failures:
+            self.opened_at = time.monotonic()
+
+
+class HedgedProvider(LLMProvider):
+    """
+    A composite provider that streams from whichever of several backends produces a first token soonest.
+
+    Backends are started in configured order, except that those which have recently been slow to produce a first
+    token are moved to the back. If a backend has not produced a token within hedge_delay seconds, or fails, the next
+    one is started alongside it. The first backend to produce a non-empty token wins, and the others are cancelled.
+    Cancellation is best-effort: a loser's thread stops at its next chunk, so a stalled loser keeps its connection
+    open until the backend responds or times out. Each backend has a circuit breaker that skips it after
+    breaker_failures consecutive failures, for breaker_reset seconds, which is also how long slowness is remembered.
+
+    Usage:
+        llm = HedgedProvider([GroqProvider(groq_key), AIStudioProvider(studio_key)], hedge_delay=0.5)
+        for t in llm.stream_turns(messages, config):
+            print(t, end='')
+    """
+
+    _CHUNK = 'chunk'
+    _DONE = 'done'
+    _ERROR = 'error'
+
+    def __init__(self, backends: List[LLMProvider], hedge_delay: float = 0.5, breaker_failures: int = 3, breaker_reset: float = 30.0):
+        if not backends:
+            raise ValueError("At least one backend is required.")
+        self.backends = backends
+        self.hedge_delay = hedge_delay
+        self.breaker_failures = breaker_failures
+        self.breaker_reset = breaker_reset
+        self.health = [BackendHealth(name=f"{type(b).__name__}({b.model})") for b in backends]
+        self._lock = threading.Lock()
+
+    @property
+    def model(self):
+        return self.backends[0].model
+
+    def _candidates(self) -> List[int]:
+        """
+        Returns the indexes of the backends we may use: closed breakers first, then those which have not recently
+        been slow, otherwise in configured order.
+        """
+        with self._lock:
+            states = [h.state(self.breaker_failures, self.breaker_reset) for h in self.health]
+            usable = [i for i, s in enumerate(states) if s != 'open']
+            slow = lambda i: self.health[i].is_slow(self.hedge_delay, self.breaker_reset)
+            return sorted(usable, key=lambda i: (states[i] == 'half_open', slow(i), i))
+
+    def _run(self, idx: int, messages: List[Dict[str, str]], config: ChatConfig, kwargs: dict, out: queue.Queue, cancel: threading.Event) -> None:
+        """
+        Drains one backend's stream into the shared queue, until it is finished or cancelled. Cancellation is only
+        noticed between chunks; a generator can't be closed from another thread while it is blocked.
+        """
+        try:
+            stream = self.backends[idx].stream_turns(messages, config, **kwargs)
+            try:
+                for chunk in stream:
+                    if cancel.is_set():
+                        return
+                    out.put((idx, self._CHUNK, chunk))
+            finally:
+                stream.close()
+            out.put((idx, self._DONE, None))
+        except Exception as e:
+            out.put((idx, self._ERROR, e))
+
+    def _record_failure(self, idx: int, error: Exception) -> None:
+        logger.warning(f"Backend {self.health[idx].name} failed: {error}")
+        with self._lock:
+            self.health[idx].record_failure(self.breaker_failures)
+
+    def stream_turns(self, messages: List[Dict[str, str]], config: ChatConfig, **kwargs) -> Generator[str, None, None]:
+        candidates = self._candidates()
+        if not candidates:
+            raise RuntimeError("All LLM backends are unavailable (circuit breakers open).")
+
+        out: queue.Queue = queue.Queue()
+        cancels: Dict[int, threading.Event] = {}
+        started: Dict[int, float] = {}
+        pending = list(candidates)
+        last_error: Optional[Exception] = None
+
+        def launch() -> float:
+            idx = pending.pop(0)
+            cancels[idx] = threading.Event()
+            started[idx] = time.monotonic()
+            threading.Thread(target=self._run, args=(idx, messages, config, kwargs, out, cancels[idx]), daemon=True).start()
+            return started[idx] + self.hedge_delay
+
+        try:
+            # Race the backends until one of them produces a real token
+            deadline = launch()
+            winner = None
+            while winner is None:
+                if not cancels and not pending:
+                    raise RuntimeError(f"All LLM backends failed: {last_error}")
+                timeout = max(0.0, deadline - time.monotonic()) if pending else None
+                try:
+                    idx, kind, payload = out.get(timeout=timeout)
+                except queue.Empty:
+                    logger.info(f"No first token after {self.hedge_delay}s, hedging to {self.health[pending[0]].name}")
+                    deadline = launch()
+                    continue
+
+                if kind == self._CHUNK:
+                    # Empty chunks don't count; some providers emit them in place of an error
+                    if payload:
+                        winner = idx
+                elif idx in cancels:
+                    last_error = payload if kind == self._ERROR else RuntimeError("empty response")
+                    self._record_failure(idx, last_error)
+                    del cancels[idx]
+                    if pending:
+                        deadline = launch()
+
+            now = time.monotonic()
+            ttft = now - started[winner]
+            with self._lock:
+                for idx, cancel in cancels.items():
+                    if idx != winner:
+                        cancel.set()
+                        # The loser has waited this long without a token, so it is at least this slow. A loser
+                        # started just before the winner answered has told us nothing, so short waits are ignored.
+                        waited = now - started[idx]
+                        if waited >= self.hedge_delay:
+                            self.health[idx].record_ttft(waited)
+            yield payload
+
+            # Stream the rest of the winner, ignoring anything the losers had in flight
+            while True:
+                idx, kind, payload = out.get()
+                if idx != winner:
+                    continue
+                if kind == self._CHUNK:
+                    yield payload
+                elif kind == self._DONE:
+                    with self._lock:
+                        self.health[winner].record_success(ttft)
+                    return
+                else:
+                    self._record_failure(winner, payload)
+                    raise payload
+        finally:
+            for cancel in cancels.values():
+                cancel.set()